@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+""" Measure the startup time of briv and check it against the target.
+
+Runs briv repeatedly on a config and file list (by default, the simple
+example) with a config cache, and reads the startup time from the metrics
+of each run. The first run fills the cache and is not counted. Exits with
+status 1 if the median startup time exceeds the target (STARTUP_TARGET in
+briv.py, unless given with --target).
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def run_briv(config, file_list, cache_dir, metrics_file):
+    """ Run briv once; return its startup time and the wall time of the process """
+
+    cmd = [ sys.executable, os.path.join(HERE, 'briv.py'), '-c', config, '-l', file_list,
+            '-y', 'none', '-f', 'yaml', '-o', os.devnull, '-C', cache_dir, '-m', metrics_file ]
+
+    wall = time.perf_counter()
+    subprocess.run(cmd, check = True, cwd = os.path.dirname(os.path.abspath(config)))
+    wall = time.perf_counter() - wall
+
+    with open(metrics_file, 'r') as stream:
+        return json.load(stream)['startup_seconds'], wall
+
+if __name__ == '__main__':
+
+    example = os.path.join(HERE, 'examples', 'simple')
+
+    parser = argparse.ArgumentParser(description="Measure the startup time of briv with a cached config")
+    parser.add_argument('--config', '-c', help='Config file (default: simple example)', default = os.path.join(example, 'config.yaml'))
+    parser.add_argument('--list', '-l', help='File list (default: simple example)', default = os.path.join(example, 'file_list.txt'))
+    parser.add_argument('--runs', '-n', help='Number of measured runs (default: 20)', type = int, default = 20)
+    parser.add_argument('--target', '-t', help='Target in ms (default: STARTUP_TARGET of briv.py)', type = float, default = None)
+
+    args = parser.parse_args()
+
+    if args.target is None:
+        sys.path.insert(0, HERE)
+        from briv import STARTUP_TARGET
+        target = STARTUP_TARGET
+    else:
+        target = args.target / 1000
+
+    config, file_list = os.path.abspath(args.config), os.path.abspath(args.list)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_dir = os.path.join(tmp, 'cache')
+        metrics_file = os.path.join(tmp, 'metrics.json')
+
+        # fill the cache
+        run_briv(config, file_list, cache_dir, metrics_file)
+
+        runs = [ run_briv(config, file_list, cache_dir, metrics_file) for _ in range(args.runs) ]
+
+    startup = statistics.median(r[0] for r in runs)
+    wall = statistics.median(r[1] for r in runs)
+
+    print(f"startup: {1000 * startup:.1f} ms (median of {args.runs} runs, target {1000 * target:.0f} ms)")
+    print(f"process: {1000 * wall:.1f} ms (including the interpreter)")
+
+    sys.exit(0 if startup <= target else 1)
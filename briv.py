@@ -1,16 +1,36 @@
 #!/usr/bin/env python3
 
-import yaml
 import os
 import sys
 import re
 import time
-import csv
+import itertools
+import contextlib
+import operator
+import datetime
 import argparse
-import hashlib
-import importlib.util
 import logging
 
+# yaml, csv, json, hashlib, pickle and importlib.util are imported where needed,
+# as most runs only need some of them and startup time matters for hooks
+START_TIME = time.perf_counter()
+
+# target for the startup time (until the file list is loaded) with a cached
+# config; see bench_startup.py
+STARTUP_TARGET = 0.020
+
+# bump whenever the structure of the checked config changes
+CONFIG_CACHE_VERSION = 3
+
+# types which may be declared in parser rules
+RULE_TYPES = [ 'int', 'float', 'date', 'bool' ]
+
+BOOL_VALUES = { 'true': True, 'yes': True, 'on': True, '1': True,
+                'false': False, 'no': False, 'off': False, '0': False }
+
+# version of the manifests written by list2yaml.py
+MANIFEST_VERSION = 2
+
 def flatfile_load(file_path):
     """Create the dictionary from the flat file, one path per line"""
     
@@ -57,8 +77,61 @@ def default_config():
 def yaml_load(file_path):
     """ Load the file list master yaml file"""
 
+    import yaml
+
+    # the C loader (libyaml) is much faster, if available
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
     with open(file_path, 'r') as stream:
-        return yaml.safe_load(stream)
+        return yaml.load(stream, Loader = loader)
+
+def config_load(file_path, cache_dir = None):
+    """ Load and check the config file, using the on-disk cache if possible """
+
+    if not cache_dir:
+        return config_check(yaml_load(file_path))
+
+    import hashlib
+    import pickle
+
+    with open(file_path, 'rb') as stream:
+        content = stream.read()
+
+    digest = hashlib.sha256(content + f"\0{CONFIG_CACHE_VERSION}".encode()).hexdigest()
+    cache_file = os.path.join(cache_dir, f"config-{digest}.pickle")
+
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as stream:
+                # unpickling runs code, so only trust a file nobody else could have written
+                if not cache_trusted(os.fstat(stream.fileno())):
+                    raise ValueError("not owned by the current user or writable by others")
+                logger.debug(f"Loading checked config from cache {cache_file}")
+                return pickle.load(stream)
+        except Exception as e:
+            logging.warning(f"Could not read config cache {cache_file}: {e}")
+
+    config = config_check(yaml_load(file_path))
+
+    try:
+        os.makedirs(cache_dir, mode = 0o700, exist_ok = True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as stream:
+            pickle.dump(config, stream)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logging.warning(f"Could not write config cache {cache_file}: {e}")
+
+    return config
+
+def cache_trusted(st):
+    """ Check that a cache file belongs to us and is not writable by others """
+
+    if not hasattr(os, 'getuid'):
+        # no ownership or permission bits to check
+        return True
+
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
 
 def read_template(file_path):
     """ Read the template markdown file """
@@ -69,6 +142,8 @@ def read_template(file_path):
 def load_function_from_file(file_path, function_name):
     """ Dyna load function from file """
 
+    import importlib.util
+
     logger.debug(f"loading function: {function_name} from {file_path}")
     spec = importlib.util.spec_from_file_location("custom_functions", file_path)
     module = importlib.util.module_from_spec(spec)
@@ -117,6 +192,30 @@ def process_match_keyword(match, match_rule):
 
     return ret
 
+def coerce_value(value, vtype):
+    """ Convert an extracted value to the type declared in the rule """
+
+    if vtype is None or value is None:
+        return value
+
+    if isinstance(value, dict):
+        return { k: coerce_value(v, vtype) for k, v in value.items() }
+
+    try:
+        if vtype == 'int':
+            return int(value)
+        if vtype == 'float':
+            return float(value)
+        if vtype == 'date':
+            return datetime.date.fromisoformat(str(value).strip())
+        if vtype == 'bool':
+            return BOOL_VALUES[str(value).strip().lower()]
+    except (ValueError, KeyError, TypeError):
+        logger.debug(f"Warning: cannot convert {value!r} to {vtype}")
+        return None
+
+    return value
+
 def process_match(obj, rule, field, funcs, match, blob):
     """ apply a rule to a blob of text """
 
@@ -141,7 +240,7 @@ def process_match(obj, rule, field, funcs, match, blob):
         return
 
     if 'string' in rule:
-        cur[field] = rule['string']
+        cur[field] = coerce_value(rule['string'], rule.get('type'))
     elif 'count' in rule:
         if field not in cur or not isinstance(cur[field], int):
             cur[field] = 0
@@ -154,19 +253,99 @@ def process_match(obj, rule, field, funcs, match, blob):
             tmp = funcs[rule['function']](match)
             logger.debug(f"Function result: {tmp}")
             logger.debug(f"cur: {cur}")
-            cur[field] = tmp
+            cur[field] = coerce_value(tmp, rule.get('type'))
         else:
-            cur[field] = funcs[rule['function']](blob)
+            cur[field] = coerce_value(funcs[rule['function']](blob), rule.get('type'))
     elif match:
         if 'match' in rule:
-            cur[field] = process_match_keyword(match, rule['match'])
+            cur[field] = coerce_value(process_match_keyword(match, rule['match']), rule.get('type'))
         else:
             n = len(match.groups())
-            cur[field] = match.group(n)
+            cur[field] = coerce_value(match.group(n), rule.get('type'))
 
     logger.debug("   + obj is now: \n", obj)
     return
 
+def find_last_match(pattern, blob, pos = 0, endpos = None, window = 4096):
+    """ Find the last match of a pattern, searching backwards from the end
+
+    Scanning a tail of the text may find a match which is part of a longer
+    match starting before the tail (e.g. with patterns spanning several
+    lines), so the candidate is only accepted once a twice as large tail
+    yields the same match and none of its matches reaches across the start
+    of the smaller tail.
+    """
+
+    endpos = len(blob) if endpos is None else endpos
+
+    # look at increasingly large tails of the text; the tail always starts
+    # at the beginning of a line so that anchors behave as usual
+    start = endpos
+    prev = None
+
+    while True:
+        start = max(pos, start - window)
+        if start > pos:
+            start = max(pos, blob.rfind('\n', pos, start) + 1)
+
+        last = None
+        across = False
+        for last in pattern.finditer(blob, start, endpos):
+            if prev and last.start() < prev[0] < last.end():
+                across = True
+
+        if start == pos:
+            return last
+
+        if prev and last and prev[1] and last.span() == prev[1].span() and not across:
+            return last
+
+        prev = (start, last)
+        window *= 2
+
+def find_matches(rule, blob, pos = 0, endpos = None):
+    """ Return the matches of a rule in blob[pos:endpos], without copying """
+
+    pattern = rule.get('pattern') or re.compile(rule['regex'], flags = re.MULTILINE)
+    endpos = len(blob) if endpos is None else endpos
+
+    if rule.get('first'):
+        # stop scanning at the first match
+        match = pattern.search(blob, pos, endpos)
+        return [ match ] if match else [ ]
+
+    if rule.get('last'):
+        match = find_last_match(pattern, blob, pos, endpos)
+        return [ match ] if match else [ ]
+
+    return pattern.finditer(blob, pos, endpos)
+
+# patterns which look before the start position, and hence behave
+# differently on a slice of the text than on the text itself
+LOOKBEHIND = re.compile(r'\\A|\(\?<[=!]')
+
+def group_span(match, rule):
+    """ Return the text (as blob, pos, endpos) of a match group for a sub-rule
+
+    Whenever possible, the sub-rule scans the buffer of the parent match in
+    place rather than a copy of the group. Returns None if the group did not
+    participate in the match.
+    """
+
+    start, end = match.span(rule['group'])
+
+    if start < 0:
+        return None
+
+    text = match.string
+
+    # at the beginning of a line, ^ and \b behave the same on a slice and
+    # in place; otherwise (or with lookbehinds) fall back to a copy
+    if start == 0 or (text[start - 1] == '\n' and not LOOKBEHIND.search(rule['regex'])):
+        return text, start, end
+
+    return text[start:end], 0, end - start
+
 def apply_rules(obj, rules, funcs, blob = None, match = None):
     """ applies a set of rules to a blob of text """
 
@@ -192,17 +371,21 @@ def apply_rules(obj, rules, funcs, blob = None, match = None):
             process_match(obj, rule, field, funcs, match, blob = blob)
             continue
 
-        blob_cur = blob
+        blob_cur, pos, endpos = blob, 0, None
 
-        # for sub-rules, use the appropriate blob
+        # for sub-rules, use the appropriate part of the blob
         if match:
             logger.debug(f"= match is {match}")
             if 'group' not in rule:
                 raise ValueError(f"No group section in rule {field} of the parser config")
-            blob_cur = match.group(rule['group'])
-            logger.debug(f"= + blob is now {blob_cur}")
-
-        for curmatch in re.finditer(rule['regex'], blob_cur, flags = re.MULTILINE):
+            span = group_span(match, rule)
+            if span is None:
+                logger.debug(f"= + group {rule['group']} did not participate in the match")
+                continue
+            blob_cur, pos, endpos = span
+            logger.debug(f"= + blob is now [{pos}:{endpos}]")
+
+        for curmatch in find_matches(rule, blob_cur, pos, endpos):
             logger.debug(f"= + Match found for {field}")
             logger.debug(f"= + Match groups: {curmatch.groups()}")
             logger.debug(f"calling process_match with obj={obj}")
@@ -211,15 +394,75 @@ def apply_rules(obj, rules, funcs, blob = None, match = None):
     return
 
 
-def file_parser(obj, config):
-    """ parse a single file """
+def read_blob(stream, read_limit = None):
+    """ Read the file contents, or only its head if read_limit is set """
+
+    if not read_limit:
+        return stream.read()
+
+    n, unit = read_limit
+
+    if unit == 'lines':
+        return ''.join(itertools.islice(stream, n))
+
+    return stream.read(n)
+
+def read_file(file_path, read_limit = None, metrics = None):
+    """ Read the file to be parsed """
+
+    with open(file_path, 'r') as stream:
+        blob = read_blob(stream, read_limit)
+
+        if metrics is not None:
+            # bytes consumed from the file, without encoding the text again
+            if read_limit:
+                nbytes = stream.buffer.tell()
+            else:
+                nbytes = os.fstat(stream.fileno()).st_size
+            metrics_count(metrics, 'files_processed')
+            metrics_count(metrics, 'bytes_read', nbytes)
+
+    return blob
+
+def limit_blob(blob, read_limit = None):
+    """ Cut an already read blob down to read_limit """
+
+    if not read_limit:
+        return blob
+
+    n, unit = read_limit
+
+    if unit != 'lines':
+        return blob[:n]
+
+    pos = -1
+    for _ in range(n):
+        pos = blob.find('\n', pos + 1)
+        if pos < 0:
+            return blob
+
+    return blob[:pos + 1]
+
+def combined_read_limit(configs):
+    """ The read_limit sufficient for all the configs """
+
+    limits = [ c['parser'].get('read_limit') for c in configs ]
+
+    if not all(limits) or len(set(unit for n, unit in limits)) > 1:
+        return None
+
+    return max(n for n, unit in limits), limits[0][1]
+
+def file_parser(obj, config, metrics = None, blob = None):
+    """ parse a single file; blob is the file contents if already read """
 
     file_path = obj['path']
     logger.debug(f"\n  |----------------|\n  |- Parsing file -| {file_path}\n  |----------------|")
 
-    # read the file to be parsed
-    with open(file_path, 'r') as stream:
-        blob = stream.read()
+    if blob is None:
+        blob = read_file(file_path, config['parser'].get('read_limit'), metrics)
+    else:
+        blob = limit_blob(blob, config['parser'].get('read_limit'))
 
     logger.debug(f"Calling apply_rules with obj={obj}")
     apply_rules(obj, config['parser']['rules'], funcs = config['funcs'], blob = blob)
@@ -233,14 +476,41 @@ def parser_check_rules(rules):
     filtered_rules = { }
 
     for k, v in rules.items():
+        if isinstance(v, str):
+            # rule *is* the regex
+            v = { 'regex': v }
         if 'regex' not in v:
             logger.debug(f"Warning: no regex section in {k} of the parser config")
+        else:
+            # compile once, not for every file
+            v['pattern'] = re.compile(v['regex'], flags = re.MULTILINE)
         filtered_rules[k] = v
         if 'subkeys' in v and ('function' in v or 'group' in v):
            logger.debug(f"Warning: parser key {k}: subkeys ignored if function or group already present")
+        if v.get('type') is not None and v['type'] not in RULE_TYPES:
+            raise ValueError(f"Parser key {k}: unsupported type {v['type']}")
+        if v.get('type') is not None and 'count' in v:
+            raise ValueError(f"Parser key {k}: counts are always int, type not supported")
+        if v.get('first') and v.get('last'):
+            raise ValueError(f"Parser key {k}: first and last are mutually exclusive")
+        if 'rules' in v:
+            v['rules'] = parser_check_rules(v['rules'])
 
     return filtered_rules
 
+def parser_check_read_limit(read_limit):
+    """ Convert read_limit (e.g. 4096, "4096 chars" or "20 lines") to (n, unit) """
+
+    if read_limit is None:
+        return None
+
+    m = re.match(r'^\s*(\d+)\s*(chars|lines|)\s*$', str(read_limit))
+
+    if not m:
+        raise ValueError(f"Invalid read_limit: {read_limit}")
+
+    return int(m.group(1)), m.group(2) or 'chars'
+
 def parser_get_funcs_rules(rules, functions_file, funcs_obj):
     """ Extract functions from a set of rules """
 
@@ -276,39 +546,122 @@ def parser_get_funcs(parser, functions_file):
 
     return funcs
 
-def new_parser(files, functions_file, config):
-    """ Fully configurable README parser """
+def config_check(config):
+    """ Check the parser definition and compile its rules """
+
+    if not 'parser' in config:
+        raise ValueError("No parser section in the config")
 
-    # checking the parser definition
     config['parser']['rules'] = parser_check_rules(config['parser']['rules'])
+    config['parser']['read_limit'] = parser_check_read_limit(config['parser'].get('read_limit'))
+
+    return config
+
+def file_parser_shared(obj, config, digest, parsed, metrics = None, blob = None):
+    """ parse a single file, unless a file with identical contents was parsed """
+
+    import copy
+
+    if digest not in parsed:
+        # parse into an empty record, so that it can be shared
+        tmp = { 'path': obj['path'] }
+        file_parser(tmp, config, metrics, blob)
+        del tmp['path']
+        parsed[digest] = tmp
+    elif metrics is not None:
+        metrics_count(metrics, 'files_deduplicated')
+
+    obj.update(copy.deepcopy(parsed[digest]))
+
+def parse_file(files, i, config, metrics = None, digests = None, parsed = None, blob = None):
+    """ Parse the i-th file and call the post_file functions on it """
+
+    f = files[i]
+
+    with metrics_stage(metrics, 'parse'):
+        if digests:
+            file_parser_shared(f, config, digests[i], parsed, metrics, blob)
+        else:
+            file_parser(f, config, metrics, blob)
+
+    if 'post_file' in config['parser']: 
+        with metrics_stage(metrics, 'post_file'):
+            for post in config['parser']['post_file']:
+                func_name = post['function']
+                logger.debug(f"Calling post function {func_name}")
+                args = post['args'] if 'args' in post else [ ]
+                kwargs = post['kwargs'] if 'kwargs' in post else { }
+                ret = config['funcs'][func_name](f, *args, **kwargs)
+                files[i] = ret
+
+def new_parser(files, functions_file, config, metrics = None, digests = None):
+    """ Fully configurable README parser 
+
+    If digests (content hashes, one per file) are given, each distinct
+    content is parsed only once.
+    """
 
     config['funcs'] = parser_get_funcs(config['parser'], functions_file)
     logger.debug("Functions:", config['funcs'])
 
+    parsed = { }
+
     # go over the files and parse them
     
     for i in range(len(files)):
-        f = files[i]
-        if 'path' in f:
-            file_parser(f, config)
-            if 'post_file' in config['parser']: 
-                for post in config['parser']['post_file']:
-                    func_name = post['function']
-                    logger.debug(f"Calling post function {func_name}")
-                    args = post['args'] if 'args' in post else [ ]
-                    kwargs = post['kwargs'] if 'kwargs' in post else { }
-                    ret = config['funcs'][func_name](f, *args, **kwargs)
-                    files[i] = ret
+        if 'path' in files[i]:
+            parse_file(files, i, config, metrics, digests, parsed)
+
+    logger.debug("\n  |================|\n  |- Parsing done -| \n  |================|")
+
+    return post_parser(files, config, metrics)
+
+def batch_parser(files, programs, metrics = None, digests = None):
+    """ Parse the files with several parser configs, reading each file once
+
+    programs is a list of (config, functions_file) tuples; returns a list
+    with the parsed files for each of them.
+    """
+
+    import copy
+
+    configs = [ config for config, functions_file in programs ]
+
+    for config, functions_file in programs:
+        config['funcs'] = parser_get_funcs(config['parser'], functions_file)
+
+    results = [ copy.deepcopy(files) for c in configs ]
+    parsed = [ { } for c in configs ]
+    read_limit = combined_read_limit(configs)
+
+    for i in range(len(files)):
+        if 'path' not in files[i]:
+            continue
+
+        # with digests, the file might not need to be read at all
+        blob = None
+        if not digests or any(digests[i] not in p for p in parsed):
+            with metrics_stage(metrics, 'parse'):
+                blob = read_file(files[i]['path'], read_limit, metrics)
+
+        for config, res, p in zip(configs, results, parsed):
+            parse_file(res, i, config, metrics, digests, p, blob)
 
     logger.debug("\n  |================|\n  |- Parsing done -| \n  |================|")
 
+    return [ post_parser(res, config, metrics) for config, res in zip(configs, results) ]
+
+def post_parser(files, config, metrics = None):
+    """ Call the post_parser functions on the parsed files """
+
     if 'post_parser' in config['parser']:
-        for post in config['parser']['post_parser']:
-            func_name = post['function']
-            logger.debug(f"Calling post parser function {func_name}")
-            args = post['args'] if 'args' in post else [ ]
-            kwargs = post['kwargs'] if 'kwargs' in post else { }
-            files = config['funcs'][func_name](files, *args, **kwargs)
+        with metrics_stage(metrics, 'post_parser'):
+            for post in config['parser']['post_parser']:
+                func_name = post['function']
+                logger.debug(f"Calling post parser function {func_name}")
+                args = post['args'] if 'args' in post else [ ]
+                kwargs = post['kwargs'] if 'kwargs' in post else { }
+                files = config['funcs'][func_name](files, *args, **kwargs)
 
     return files
 
@@ -383,6 +736,8 @@ def save_csv(files, file_path, config):
         # text contains the record as yaml, we don't want that
         fields = [ k for k in fields if k not in ['text'] ]
 
+    import csv
+
     def write_csv(file, fields, pflat):
         writer = csv.DictWriter(file, fieldnames=fields)
         writer.writeheader()
@@ -446,9 +801,11 @@ def make_list(pflat, item):
     return output_list
 
 
-def remove_duplicates(files):
+def remove_duplicates(files, metrics = None):
     """Check for duplicate paths, keep only the last one"""
 
+    n = len(files)
+
     # reverse the list to keep the last one
     files.reverse()
 
@@ -458,30 +815,116 @@ def remove_duplicates(files):
     # reverse back
     files.reverse()
 
+    if metrics is not None:
+        metrics_count(metrics, 'duplicates_removed', n - len(files))
+
     return files
 
-def skip_dirs_and_absent(files):
+def skip_dirs_and_absent(files, metrics = None):
     """ Skip directories and absent files """
 
     ret = [ f for f in files if os.path.exists(f['path']) ]
     ret = [ f for f in ret if os.path.isfile(f['path']) ]
 
+    missing = 0
+
     for f in files:
         if not os.path.exists(f['path']):
             logging.warning(f"file {f['path']} does not exist, skipping")
+            missing += 1
         elif os.path.isdir(f['path']):
             logging.warning(f"file {f['path']} is a directory, skipping")
 
+    if metrics is not None:
+        metrics_count(metrics, 'files_missing', missing)
+        metrics_count(metrics, 'files_skipped', len(files) - len(ret) - missing)
+
     return ret
 
 def generate_ids(files):
     """generate unique ids for the files"""
 
+    import hashlib
+
     for f in files:
         f['id'] =  hashlib.md5(f['path'].encode()).hexdigest()
 
     return files
 
+def hash_file(file_path, chunk_size = 1 << 20):
+    """ Calculate a fast digest of the file contents """
+
+    import hashlib
+
+    digest = hashlib.blake2b(digest_size = 16)
+
+    with open(file_path, 'rb') as stream:
+        while chunk := stream.read(chunk_size):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def content_digest(f):
+    """ Return the digest recorded in a (trusted) manifest or hash the file """
+
+    return (f.get('_manifest') or { }).get('digest') or hash_file(f['path'])
+
+def content_hashes(files, workers = None):
+    """ Calculate the content digests of the files in parallel """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # hashlib releases the GIL while hashing, so threads are sufficient
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        return list(executor.map(content_digest, files))
+
+def manifest_check(files, metrics = None):
+    """ Check the files of a trusted manifest with a single stat per file
+
+    Absent files and non-files are skipped with a warning; the recorded
+    digest of a file which changed since the manifest was made is dropped.
+    """
+
+    import stat
+
+    ret = [ ]
+    missing = 0
+
+    for f in files:
+        meta = f.setdefault('_manifest', { })
+
+        try:
+            st = os.stat(f['path'])
+        except OSError:
+            logging.warning(f"file {f['path']} does not exist, skipping")
+            missing += 1
+            continue
+
+        if not stat.S_ISREG(st.st_mode):
+            logging.warning(f"file {f['path']} is not a file, skipping")
+            continue
+
+        if (meta.get('size'), meta.get('mtime'), meta.get('inode')) != (st.st_size, st.st_mtime, st.st_ino):
+            meta.pop('digest', None)
+
+        ret.append(f)
+
+    if metrics is not None:
+        metrics_count(metrics, 'files_missing', missing)
+        metrics_count(metrics, 'files_skipped', len(files) - len(ret) - missing)
+
+    return ret
+
+def manifest_fresh(listing, max_age):
+    """ Check whether a file list is a manifest recent enough to be trusted """
+
+    meta = listing.get('manifest')
+
+    if not isinstance(meta, dict) or meta.get('version') != MANIFEST_VERSION:
+        return False
+
+    return time.time() - meta.get('created', 0) <= max_age
+
 def realpaths(files):
     """Convert the paths into absolute full paths, following symlinks etc."""
 
@@ -490,71 +933,486 @@ def realpaths(files):
 
     return files
 
-def filter_by_condition(files, condition, all_fields):
-    """Filter the files by a pattern"""
+# comparison operators of the filters
+COMPARISONS = { '<': operator.lt, '<=': operator.le, '>': operator.gt,
+                '>=': operator.ge, '==': operator.eq, '!=': operator.ne }
+
+# python types of the values of typed fields; other values (e.g. set by a
+# post_file function) are treated as missing when comparing
+TYPE_CLASSES = { 'int': int, 'float': (int, float), 'date': datetime.date, 'bool': bool }
+
+# below this number of records, numpy is not worth importing
+NUMPY_MIN_ROWS = 10000
+
+def get_numpy(n):
+    """Return numpy if it is available and worth using for n records"""
+
+    if n < NUMPY_MIN_ROWS:
+        return None
+
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+def declared_types(rules, prefix = ""):
+    """Collect the types declared in the parser rules, by flattened field name
+
+    Fields named by the 'key' keyword are only known after parsing and
+    therefore not included.
+    """
+
+    types = { }
+
+    for name, rule in rules.items():
+        if not isinstance(rule, dict) or 'key' in rule:
+            continue
+
+        if 'rules' in rule:
+            types.update(declared_types(rule['rules'], prefix + name + "_"))
+        elif rule.get('type'):
+            # string and function take precedence over match
+            if isinstance(rule.get('match'), dict) and not ('string' in rule or 'function' in rule):
+                for k in rule['match']:
+                    types[prefix + name + "_" + k] = rule['type']
+            else:
+                types[prefix + name] = rule['type']
+
+    return types
+
+def new_columns(types):
+    """Create the store of packed columns for the typed fields"""
+
+    return { 'types': types, 'packed': { } }
+
+def reset_columns(columns):
+    """Drop the packed columns (e.g. after selecting rows without numpy)"""
+
+    return columns and new_columns(columns['types'])
+
+def subset_columns(columns, index):
+    """Select the rows given by index (a numpy array) from packed columns"""
+
+    if columns is None:
+        return None
+
+    packed = { }
+
+    for k, col in columns['packed'].items():
+        if col is None:
+            # the field could not be packed, no need to try again
+            packed[k] = None
+        else:
+            kind, data, present = col
+            packed[k] = (kind, data[index], present[index])
+
+    return { 'types': columns['types'], 'packed': packed }
+
+def get_column(files, field, columns):
+    """Return (kind, data, present) of a typed field packed as numpy arrays
+
+    The column is packed once and then reused. Returns None if the field is
+    not typed, numpy is not used for this number of files, or the values do
+    not fit (e.g. integers beyond 64 bits).
+    """
+
+    if columns is None or field not in columns['types']:
+        return None
+
+    np = get_numpy(len(files))
+
+    if np is None:
+        return None
+
+    if field in columns['packed']:
+        return columns['packed'][field]
+
+    kind = columns['types'][field]
+    values = [ p.get(field) for p in files ]
+    present = np.fromiter((v is not None for v in values), dtype = bool, count = len(values))
+
+    try:
+        if kind == 'float':
+            data = np.fromiter((float('nan') if v is None else v for v in values), dtype = np.float64, count = len(values))
+        elif kind == 'date':
+            data = np.fromiter((0 if v is None else v.toordinal() for v in values), dtype = np.int64, count = len(values))
+        else:
+            # int and bool: exact 64 bit integers
+            data = np.fromiter((0 if v is None else v for v in values), dtype = np.int64, count = len(values))
+    except (TypeError, ValueError, AttributeError, OverflowError):
+        logger.debug(f"Warning: cannot pack values of {field} as {kind}")
+        columns['packed'][field] = None
+        return None
+
+    columns['packed'][field] = (kind, data, present)
+
+    return columns['packed'][field]
+
+def convert_value(kind, value):
+    """Convert the value of a condition to the type of a field"""
+
+    if kind == 'date':
+        return datetime.date.fromisoformat(value)
+
+    if kind == 'bool':
+        return BOOL_VALUES[value.lower()]
+
+    number = to_number(value)
+
+    if number is None:
+        raise ValueError(f"Not a number: {value}")
+
+    return number
+
+def pack_value(kind, value):
+    """Convert a typed value for comparing with a packed column"""
+
+    if kind == 'date':
+        return value.toordinal()
+
+    if kind == 'bool':
+        return int(value)
+
+    return value
+
+def filter_by_condition(files, condition, all_fields, columns = None):
+    """Filter the files by a pattern
+
+    Returns the filtered files and the packed columns of these files.
+    """
 
     condition = condition.strip()
 
     if condition == "-":
-        return files
+        return files, columns
 
-    field, operator, value = re.split(r'\s*(~|!~|==|!=|<|>|<=|>=)\s*', condition)
+    field, op, value = re.split(r'\s*(!~|~|==|!=|<=|>=|<|>)\s*', condition)
     # check whether split was effective
 
     if field not in all_fields:
         logger.debug(f"Warning: probably invalid field {field}, ignoring filter `{condition}`")
-        return files
+        return files, columns
 
-    if len(field) == 0 or len(operator) == 0 or len(value) == 0:
+    if len(field) == 0 or len(op) == 0 or len(value) == 0:
         logger.debug(f"Invalid condition {condition}")
-        return files
-
-    value = int(value) if value.isdigit() else value.strip('"')
-
-    if operator == "<":
-        return [p for p in files if p[field] < value]
-    elif operator == "<=":
-        return [p for p in files if p[field] <= value]
-    elif operator == ">":
-        return [p for p in files if p[field] > value]
-    elif operator == ">=":
-        return [p for p in files if p[field] >= value]
-    elif operator == "==":
-        return [p for p in files if p[field] == value]
-    elif operator == "!=":
-        return [p for p in files if p[field] != value]
-    elif operator == "~":
-        return [p for p in files if p.get(field) and re.search(value, p.get(field))]
-    elif operator == "!~":
-        return [p for p in files if p.get(field) and not re.search(value, p.get(field))]
+        return files, columns
+
+    # a quoted value is always compared as a string with untyped fields
+    quoted = value.startswith('"')
+    value = value.strip('"')
+    kind = columns['types'].get(field) if columns else None
+
+    if op in COMPARISONS and kind:
+        try:
+            value = convert_value(kind, value)
+        except (ValueError, KeyError):
+            logger.debug(f"Warning: cannot compare {field} ({kind}) with {value}, ignoring filter `{condition}`")
+            return files, columns
+
+        col = get_column(files, field, columns)
+
+        if col:
+            # compare the whole column at once; missing values never match
+            np = get_numpy(len(files))
+            kind, data, present = col
+            index = np.flatnonzero(COMPARISONS[op](data, pack_value(kind, value)) & present)
+            return [ files[i] for i in index.tolist() ], subset_columns(columns, index)
+
+        cmp, cls = COMPARISONS[op], TYPE_CLASSES[kind]
+        return [p for p in files if isinstance(p.get(field), cls) and cmp(p[field], value)], reset_columns(columns)
+
+    columns = reset_columns(columns)
+
+    if op == '!=' and not quoted and to_number(value) is not None:
+        # untyped field compared with a number; values which are not
+        # numbers are not equal to it
+        value = to_number(value)
+        return [p for p in files if p.get(field) is not None and to_number(p[field]) != value], columns
+
+    if op in COMPARISONS and not quoted and to_number(value) is not None:
+        # untyped field compared with a number: compare numerically
+        cmp, value = COMPARISONS[op], to_number(value)
+        return [p for p in files if (v := to_number(p.get(field))) is not None and cmp(v, value)], columns
+
+    if op in COMPARISONS:
+        logger.debug(f"Comparing untyped field {field} as a string in `{condition}`")
+        cmp = COMPARISONS[op]
+        return [p for p in files if p.get(field) is not None and cmp(str(p[field]), value)], columns
+    elif op == "~":
+        return [p for p in files if p.get(field) is not None and re.search(value, str(p[field]))], columns
+    elif op == "!~":
+        return [p for p in files if p.get(field) is not None and not re.search(value, str(p[field]))], columns
     else:
-        raise ValueError(f"Unsupported operator: {operator}")
+        raise ValueError(f"Unsupported operator: {op}")
 
-def filter_files(files, pattern_str, all_fields):
-    """Filter the files by a pattern"""
+def filter_files(files, pattern_str, all_fields, columns = None):
+    """Filter the files by a pattern
+
+    Returns the filtered files and the packed columns of these files.
+    """
 
     conditions = re.split(r'\s*,\s*', pattern_str)
 
     for c in conditions:
-        files = filter_by_condition(files, c, all_fields)
+        files, columns = filter_by_condition(files, c, all_fields, columns)
 
-    return files
+    return files, columns
 
-def sort_files(files, sort, desc, all_fields):
-    """Sort the files by a field"""
+def sort_files(files, sort, desc, all_fields, limit = None, columns = None):
+    """Sort the files by a field; with limit, only the first limit files
+
+    Files in which the field is missing come last. Returns the sorted files
+    and the packed columns of these files.
+    """
 
     if not sort in all_fields:
         logger.debug(f"Warning: probably invalid field {sort}, ignoring sort")
-        return files
+        return (files if limit is None else files[:limit]), reset_columns(columns)
+
+    col = get_column(files, sort, columns)
+
+    if col:
+        np = get_numpy(len(files))
+        kind, data, present = col
+        index = np.flatnonzero(present)
+        index = index[np.argsort(data[index], kind = 'stable')]
+        if desc:
+            index = index[::-1]
+        index = np.concatenate([ index, np.flatnonzero(~present) ])
+        if limit is not None:
+            index = index[:limit]
+        return [ files[i] for i in index.tolist() ], subset_columns(columns, index)
+
+    present = [ p for p in files if p.get(sort) is not None ]
+    missing = [ p for p in files if p.get(sort) is None ]
 
-    files = sorted(files, key = lambda x: x.get(sort))
+    kind = columns['types'].get(sort) if columns else None
+
+    if kind and all(isinstance(p[sort], TYPE_CLASSES[kind]) for p in present):
+        key = lambda x: x[sort]
+    else:
+        # untyped field: numerically if all values are numbers
+        numbers = [ to_number(p[sort]) for p in present ]
+        if None in numbers:
+            key = lambda x: str(x[sort])
+        else:
+            key = lambda x: to_number(x[sort])
+
+    if limit is not None and limit < len(present):
+        import heapq
+
+        # partial sort, no need to sort all files to show a few; the index
+        # in the key orders ties as the full sort would
+        select = heapq.nlargest if desc else heapq.nsmallest
+        order = select(limit, range(len(present)), key = lambda i: (key(present[i]), i))
+        return [ present[i] for i in order ], reset_columns(columns)
+
+    files = sorted(present, key = key)
 
     if desc:
         files.reverse()
 
+    files += missing
+
+    return (files if limit is None else files[:limit]), reset_columns(columns)
+
+def to_number(value):
+    """Convert a value to a number, return None if not possible"""
+
+    if isinstance(value, bool):
+        return None
+
+    if isinstance(value, (int, float)):
+        return value
+
+    if isinstance(value, str):
+        for conv in (int, float):
+            try:
+                return conv(value)
+            except ValueError:
+                pass
+
+    return None
+
+def agg_value(value, func):
+    """The value of a field by which it is aggregated (None to skip it)
+
+    For min and max, this is only the key for comparing values; the result
+    is the original value of the field.
+    """
+
+    if isinstance(value, datetime.date):
+        return None if func == 'sum' else value
+
+    if isinstance(value, bool):
+        return int(value) if func == 'sum' else value
+
+    return to_number(value)
+
+def column_fits(col, func):
+    """Check whether a packed column can be aggregated exactly"""
+
+    np = get_numpy(len(col[1]))
+    kind, data, present = col
+    data = data[present]
+
+    # the sum of integers might overflow 64 bits
+    return kind == 'float' or func != 'sum' or not len(data) or int(np.abs(data).max()) * len(data) < 2 ** 63
+
+def aggregate_column(col, codes, n, func):
+    """Aggregate a packed column for n groups"""
+
+    np = get_numpy(len(codes))
+    kind, data, present = col
+    codes, data = codes[present], data[present]
+
+    if func == 'sum':
+        res = np.zeros(n, dtype = data.dtype)
+        np.add.at(res, codes, data)
+    elif func == 'min':
+        res = np.full(n, np.iinfo(np.int64).max if data.dtype == np.int64 else np.inf, dtype = data.dtype)
+        np.minimum.at(res, codes, data)
+    else:
+        res = np.full(n, np.iinfo(np.int64).min if data.dtype == np.int64 else -np.inf, dtype = data.dtype)
+        np.maximum.at(res, codes, data)
+
+    seen = np.bincount(codes, minlength = n) > 0
+    res = res.tolist()
+
+    if kind == 'date' and func != 'sum':
+        res = [ datetime.date.fromordinal(r) for r in res ]
+    elif kind == 'bool' and func != 'sum':
+        res = [ bool(r) for r in res ]
+
+    return [ r if s else None for r, s in zip(res, seen.tolist()) ]
+
+def group_files(files, field, aggs, all_fields, columns = None):
+    """Group the files by a field and aggregate other fields
+
+    aggs is a list of (function, field) tuples, where function is one of
+    count, sum, min or max. The number of files in each group is always
+    recorded as 'count'; other aggregates are stored as function_field
+    (e.g. sum_size) and only take numbers, dates and booleans into account.
+    All aggregates are calculated in a single pass over the files, except
+    for packed typed columns, which are aggregated as a whole.
+    """
+
+    if not field in all_fields:
+        logger.debug(f"Warning: probably invalid field {field}, ignoring group by")
+        return files
+
+    aggs = [ (f, v) for f, v in aggs if f != 'count' ]
+
+    # typed fields which can be aggregated on the packed column
+    packed = { }
+    for func, v in aggs:
+        col = get_column(files, v, columns)
+        if col and column_fits(col, func):
+            packed[(func, v)] = col
+
+    rows = [ (j, func, v) for j, (func, v) in enumerate(aggs) if (func, v) not in packed ]
+    groups = { }
+    codes = [ ] if packed else None
+
+    for p in files:
+        key = p.get(field)
+        g = groups.get(key)
+
+        if g is None:
+            # the count, the index of the group and the aggregates so far
+            g = groups[key] = [ 0, len(groups), [ None ] * len(aggs) ]
+
+        g[0] += 1
+
+        if codes is not None:
+            codes.append(g[1])
+
+        state = g[2]
+
+        for j, func, v in rows:
+            value = p.get(v)
+            x = agg_value(value, func)
+
+            if x is None:
+                continue
+
+            if func == 'sum':
+                state[j] = x if state[j] is None else state[j] + x
+            elif state[j] is None or (x < state[j][0] if func == 'min' else x > state[j][0]):
+                state[j] = (x, value)
+
+    res = [ ]
+
+    for key, (count, i, state) in groups.items():
+        g = { field: key, 'count': count }
+        for (func, v), x in zip(aggs, state):
+            g[f"{func}_{v}"] = x[1] if isinstance(x, tuple) else x
+        res.append(g)
+
+    if packed:
+        np = get_numpy(len(files))
+        codes = np.array(codes, dtype = np.int64)
+
+        for (func, v), col in packed.items():
+            for g, r in zip(res, aggregate_column(col, codes, len(res), func)):
+                g[f"{func}_{v}"] = r
+
+    return res
+
+def parse_group(stage):
+    """Parse 'group by FIELD[, func field[, ...]]' into field and aggregates"""
+
+    m = re.match(r'^group +by +(\w+)((?: *, *(?:count|sum|min|max)(?: +\w+)?)*)$', stage)
+
+    if not m:
+        raise ValueError(f"Invalid group by specification: {stage}")
+
+    aggs = [ tuple(a.split()) for a in re.split(r' *, *', m.group(2).strip(' ,')) if a ]
+    aggs = [ a if len(a) == 2 else (a[0], m.group(1)) for a in aggs ]
+
+    return m.group(1), aggs
+
+def apply_stages(files, stages, all_fields, columns = None):
+    """Apply the sort, limit and group by stages of a placeholder in order"""
+
+    stages = [ s.strip() for s in stages.split('|') if s.strip() ]
+    limits = [ re.match(r'^limit +(\d+)$', s) for s in stages ]
+
+    i = 0
+    while i < len(stages):
+        stage = stages[i]
+
+        if limits[i]:
+            n = int(limits[i].group(1))
+            files = files[:n]
+            if columns and columns['packed']:
+                columns = subset_columns(columns, slice(0, n))
+
+        elif stage.startswith('group '):
+            field, aggs = parse_group(stage)
+            files = group_files(files, field, aggs, all_fields, columns)
+            all_fields = set([ field, 'count' ] + [ f"{f}_{v}" for f, v in aggs if f != 'count' ])
+            columns = None
+
+        else:
+            m = re.match(r'^(desc +)?(\S+)$', stage)
+            if not m:
+                raise ValueError(f"Invalid sort specification: {stage}")
+
+            # a limit directly after the sort turns it into a partial sort
+            limit = None
+            if i + 1 < len(stages) and limits[i + 1]:
+                limit = int(limits[i + 1].group(1))
+                i += 1
+
+            files, columns = sort_files(files, m.group(2), bool(m.group(1)), all_fields, limit, columns)
+
+        i += 1
+
     return files
 
-def match_replace(match, printer, files, all_fields, func_file):
+def match_replace(match, printer, files, all_fields, func_file, columns = None):
     """ 
     Process a match to a moustache and produce replacement 
 
@@ -563,6 +1421,7 @@ def match_replace(match, printer, files, all_fields, func_file):
     files: list of file dictionaries to process
     all_fields: set of all fields in the files
     func_file: file with the functions to call
+    columns: packed columns of the typed fields (see new_columns())
     """
 
     m = match.groupdict()
@@ -571,8 +1430,7 @@ def match_replace(match, printer, files, all_fields, func_file):
     params = m['params'].strip()
 
     filt = m['filter'].strip() if m['filter'] else None
-    sort = m['sort'].strip() if m['sort'] else None
-    desc = True if m['desc'] else False
+    stages = m['stages'] or ""
 
     print_style = printer[rule].get('style', 'table_md')
 
@@ -584,10 +1442,9 @@ def match_replace(match, printer, files, all_fields, func_file):
         return func(files, params)
 
     if filt:
-        files = filter_files(files, filt, all_fields)
+        files, columns = filter_files(files, filt, all_fields, columns)
 
-    if sort:
-        files = sort_files(files, sort, desc, all_fields)
+    files = apply_stages(files, stages, all_fields, columns)
 
     if print_style == "table_md":
         return make_table(files, printer[rule].get('columns'))
@@ -617,22 +1474,252 @@ def moustache_replace(config, template, files, func_file):
     printer_rules = '|'.join(printer.keys())
 
     # first, these without a pattern
-    pattern = r"{{ +(?P<rule>" + printer_rules + r")(?P<params>| +\| +(?P<filter>[^|\n]+)(| +\| +((?P<desc>desc) +|)(?P<sort>.+))) +}}"
+    pattern = r"{{ +(?P<rule>" + printer_rules + r")(?P<params>| +\| +(?P<filter>[^|\n]+?)(?P<stages>(?: +\| +[^|\n]+?)*)) +}}"
 
     # get all possible keys
     all_fields = set()
     for p in files:
         all_fields.update(p.keys())
 
+    # typed columns are packed once and shared by all placeholders
+    columns = new_columns(declared_types(config['parser']['rules']))
+
     def replace(match):
         """ function called to process the replacement """
 
-        return match_replace(match, printer, files, all_fields, func_file)
+        return match_replace(match, printer, files, all_fields, func_file, columns)
 
     ret = re.sub(pattern, replace, template)
 
     return ret
 
+# ------------------ Jobs ------------------
+
+def job_check(job):
+    """ Check a job (config, template, output, format and functions) """
+
+    if job.get('template'):
+        job['format'] = 'template'
+
+    if not job.get('format'):
+        job['format'] = 'yaml'
+
+    if job['format'] == 'template' and not job.get('template'):
+        logger.debug("Template file (option -t) required for template output")
+        sys.exit(1)
+
+    if job['format'] not in [ 'template', 'yaml', 'csv' ]:
+        raise ValueError(f"Unsupported format: {job['format']}")
+
+    return job
+
+def batch_load(file_path, defaults):
+    """ Load the jobs from a batch file
+
+    Relative paths in the batch file are relative to its location; the
+    functions file defaults to the one given on the command line.
+    """
+
+    batch = yaml_load(file_path)
+
+    if not batch or not batch.get('jobs'):
+        raise ValueError(f"No jobs section in {file_path}")
+
+    base = os.path.dirname(os.path.abspath(file_path))
+    jobs = [ ]
+
+    for job in batch['jobs']:
+        job = dict(job)
+        for k in [ 'config', 'template', 'output', 'functions' ]:
+            if job.get(k):
+                job[k] = os.path.join(base, os.path.expanduser(job[k]))
+        job.setdefault('functions', defaults['functions'])
+        jobs.append(job_check(job))
+
+    return jobs
+
+def job_programs(jobs):
+    """ Find the distinct parser configs of the jobs
+
+    Returns the list of (config, functions_file) tuples and, for each job,
+    the index of its program in that list.
+    """
+
+    programs = [ ]
+    keys = { }
+    index = [ ]
+
+    for job in jobs:
+        key = (job['functions'], repr(job['config']['parser']))
+        if key not in keys:
+            keys[key] = len(programs)
+            programs.append((job['config'], job['functions']))
+        index.append(keys[key])
+
+    return programs, index
+
+def write_output(files, job, metrics = None):
+    """ Write the parsed files in the format requested by a job """
+
+    config, output = job['config'], job.get('output')
+
+    if job['format'] == 'template' or job['format'] == 'yaml':
+        with metrics_stage(metrics, 'render'):
+            if job['format'] == 'template':
+                if not os.path.exists(job['template']):
+                    logger.debug(f"Template file {job['template']} not found")
+                    sys.exit(1)
+
+                # process the template
+                template = read_template(job['template'])
+                cont = moustache_replace(config, template, files, job['functions'])
+
+            else:
+                import yaml
+                cont = yaml.dump(files, default_flow_style=False, sort_keys=False)
+
+        # write to README.md or stdout
+        with metrics_stage(metrics, 'write'):
+            if not output:
+                print(cont)
+            else:
+                with open(output, 'w') as stream:
+                    stream.write(cont)
+
+    elif job['format'] == 'csv':
+        with metrics_stage(metrics, 'write'):
+            save_csv(files, output, config)
+
+    else:
+        raise ValueError(f"Unsupported format: {job['format']}")
+
+    return output
+
+# ------------------ Metrics ------------------
+
+def metrics_new(tracemalloc_top = 0):
+    """ Create the structure collecting run metrics """
+
+    if tracemalloc_top:
+        import tracemalloc
+        tracemalloc.start()
+
+    return { 'stages': { }, 'counters': { }, 'tracemalloc_top': tracemalloc_top }
+
+@contextlib.contextmanager
+def metrics_stage(metrics, stage):
+    """ Record wall and CPU time of a pipeline stage (accumulated over calls) """
+
+    if metrics is None:
+        yield
+        return
+
+    wall, cpu = time.perf_counter(), time.process_time()
+
+    try:
+        yield
+    finally:
+        cur = metrics['stages'].setdefault(stage, { 'wall_seconds': 0.0, 'cpu_seconds': 0.0 })
+        cur['wall_seconds'] += time.perf_counter() - wall
+        cur['cpu_seconds'] += time.process_time() - cpu
+
+def metrics_count(metrics, counter, n = 1):
+    """ Increase a counter """
+
+    metrics['counters'][counter] = metrics['counters'].get(counter, 0) + n
+
+def peak_rss():
+    """ Peak resident set size in bytes, or None if not available """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def metrics_finish(metrics):
+    """ Collect the final metrics: peak RSS and top allocators """
+
+    ret = { 'stages': metrics['stages'], 'counters': metrics['counters'] }
+    ret['startup_seconds'] = metrics.get('startup_seconds')
+    ret['peak_rss_bytes'] = peak_rss()
+
+    if metrics['tracemalloc_top']:
+        import tracemalloc
+        stats = tracemalloc.take_snapshot().statistics('lineno')
+        ret['tracemalloc_top'] = [ { 'location': str(s.traceback), 'size_bytes': s.size, 'count': s.count }
+                                   for s in stats[:metrics['tracemalloc_top']] ]
+        tracemalloc.stop()
+
+    return ret
+
+def prometheus_escape(value):
+    """ Escape a label value for the Prometheus text format """
+
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metrics_prometheus(metrics):
+    """ Format the metrics in the Prometheus text exposition format """
+
+    lines = [ ]
+
+    def add(name, desc, samples):
+        lines.append(f"# HELP briv_{name} {desc}")
+        lines.append(f"# TYPE briv_{name} gauge")
+        for labels, value in samples:
+            labels = ','.join(f'{k}="{prometheus_escape(v)}"' for k, v in labels.items())
+            labels = '{' + labels + '}' if labels else ''
+            lines.append(f"briv_{name}{labels} {value}")
+
+    stages = metrics['stages']
+    add('stage_wall_seconds', 'Wall time spent in a pipeline stage',
+        [ ({ 'stage': k }, v['wall_seconds']) for k, v in stages.items() ])
+    add('stage_cpu_seconds', 'CPU time spent in a pipeline stage',
+        [ ({ 'stage': k }, v['cpu_seconds']) for k, v in stages.items() ])
+
+    for k, v in metrics['counters'].items():
+        add(k, f"Number of {k.replace('_', ' ')}", [ ({ }, v) ])
+
+    if metrics['startup_seconds'] is not None:
+        add('startup_seconds', 'Time from the module imports until the file list was loaded', [ ({ }, metrics['startup_seconds']) ])
+
+    if metrics['peak_rss_bytes'] is not None:
+        add('peak_rss_bytes', 'Peak resident set size in bytes', [ ({ }, metrics['peak_rss_bytes']) ])
+
+    if 'tracemalloc_top' in metrics:
+        add('tracemalloc_top_bytes', 'Memory allocated by the top allocation sites',
+            [ ({ 'location': t['location'] }, t['size_bytes']) for t in metrics['tracemalloc_top'] ])
+
+    return '\n'.join(lines) + '\n'
+
+def save_metrics(metrics, file_path, fmt = None):
+    """ Write the metrics as JSON or in the Prometheus textfile format """
+
+    metrics = metrics_finish(metrics)
+
+    if not fmt:
+        fmt = 'prometheus' if file_path.endswith('.prom') else 'json'
+
+    if fmt == 'prometheus':
+        cont = metrics_prometheus(metrics)
+    elif fmt == 'json':
+        import json
+        cont = json.dumps(metrics, indent = 2) + '\n'
+    else:
+        raise ValueError(f"Unsupported metrics format: {fmt}")
+
+    # write atomically, so that a scraper never sees a partial file
+    tmp_file = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as stream:
+        stream.write(cont)
+    os.replace(tmp_file, file_path)
+
+    return file_path
+
 # ------------------ Main ------------------
 
 if __name__ == '__main__':
@@ -654,41 +1741,53 @@ the config files and the template files distributed with this program.
 
     """
     parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('--format', '-f', help='Output format: csv, template, yaml (default: yaml)', default = "yaml")
+    parser.add_argument('--format', '-f', help='Output format: csv, template, yaml (default: yaml)', default = None)
     parser.add_argument('--template', '-t', help='Path to the template (required if format is template; implies format=template)', default = None)
     parser.add_argument('--list', '-l', help='Path to the file list (text, default None)', default = None)
     parser.add_argument('--yaml', '-y', help='Path to the file list as yaml (default file_list.yaml; use "none" to ignore)', default = "list.yaml")
+    parser.add_argument('--manifest-max-age', help='Trust manifests created by list2yaml.py at most this many seconds ago and skip file checks (default: 3600; 0 to disable)', type = float, default = 3600)
     parser.add_argument('--output', '-o', help='File to generate (default: stdout)', default = None)
     parser.add_argument('--config', '-c', help='Config file in yaml format')
     parser.add_argument('--functions', '-F', help='Functions file (default: custom_functions.py)', default = 'custom_functions.py')
+    parser.add_argument('--batch', '-b', help='Batch file with several jobs (config, template, output, format) run in one pass over the files', default = None)
+    parser.add_argument('--cache-dir', '-C', help='Directory for caching the checked config (default: no caching)', default = None)
+    parser.add_argument('--dedup-content', '-D', help='Parse files with identical contents only once', action = 'store_true', default = False)
+    parser.add_argument('--content-hash', '-H', help='Add the content digest of each file as field content_hash', action = 'store_true', default = False)
+    parser.add_argument('--metrics', '-m', help='Write per-stage run metrics to this file (default: none)', default = None)
+    parser.add_argument('--metrics-format', help='Metrics format: json, prometheus (default: prometheus for *.prom, json otherwise)', default = None)
+    parser.add_argument('--tracemalloc', help='Include the top N memory allocators in the metrics (default: 0)', type = int, default = 0)
     parser.add_argument('--debug', '-d', help='Debug mode', action = 'store_true', default = False)
 
     args = parser.parse_args()
 
+    if args.batch:
+        given = [ opt for opt, v in [ ('-c', args.config), ('-t', args.template), ('-f', args.format), ('-o', args.output) ] if v ]
+        if given:
+            parser.error(f"{', '.join(given)} cannot be used with -b; define them in the jobs of the batch file")
+
     log_level = logging.DEBUG if args.debug else logging.INFO
     logging.basicConfig(level=log_level, format='%(levelname)s: %(funcName)s: %(message)s')
     logger = logging.getLogger(__name__)
     if args.debug:
         logging.debug("Debug mode on")
 
-
-    if args.format == 'template' and not args.template:
-        logger.debug("Template file (option -t) required for template output")
-        sys.exit(1)
-
-    if args.template:
-        args.format = 'template'
-
     yaml_file = args.yaml
     list_file = args.list
 
-    if not args.config:
-        config = default_config()
-    else:
-        config = yaml_load(args.config)
+    metrics = metrics_new(args.tracemalloc) if args.metrics else None
 
-    if not 'parser' in config:
-        raise ValueError(f"No parser section in {args.config}")
+    with metrics_stage(metrics, 'load_config'):
+        if args.batch:
+            jobs = batch_load(args.batch, { 'functions': args.functions })
+        else:
+            jobs = [ job_check({ 'config': args.config, 'template': args.template, 'output': args.output,
+                                 'format': args.format, 'functions': args.functions }) ]
+
+        for job in jobs:
+            if not job.get('config'):
+                job['config'] = config_check(default_config())
+            else:
+                job['config'] = config_load(job['config'], args.cache_dir)
 
     # Load the file list file
     files = [ ]
@@ -697,60 +1796,87 @@ the config files and the template files distributed with this program.
         logger.debug(f"Neither yaml_file nor list_file provided")
         sys.exit(1)
 
-    if args.list == '-':
-        logger.debug("Reading from stdin")
-        files += flatfile_load(None)
-        logger.debug(f"Read {len(files)} files from stdin")
-    elif args.list:
-        if os.path.exists(args.list):
-            files += flatfile_load(args.list)
-            logger.debug(f"Read {len(files)} files from {args.list}")
-        else:
-            logger.debug(f"List file {args.list} not found")
-            sys.exit(1)
+    with metrics_stage(metrics, 'load_list'):
+        if args.list == '-':
+            logger.debug("Reading from stdin")
+            files += flatfile_load(None)
+            logger.debug(f"Read {len(files)} files from stdin")
+        elif args.list:
+            if os.path.exists(args.list):
+                files += flatfile_load(args.list)
+                logger.debug(f"Read {len(files)} files from {args.list}")
+            else:
+                logger.debug(f"List file {args.list} not found")
+                sys.exit(1)
+
+        manifest_files = [ ]
 
-    files += yaml_load(args.yaml)['files'] if args.yaml.lower() != "none" and os.path.exists(args.yaml) else [ ]
+        if args.yaml.lower() != "none" and os.path.exists(args.yaml):
+            listing = yaml_load(args.yaml)
+            manifest_files = listing['files']
 
-    if len(files) == 0:
+            if manifest_fresh(listing, args.manifest_max_age):
+                logger.debug(f"Trusting manifest {args.yaml}, checking files against it")
+            else:
+                # the metadata of a stale manifest can not be trusted
+                for f in manifest_files:
+                    f.pop('_manifest', None)
+                files += manifest_files
+                manifest_files = [ ]
+
+    if len(files) + len(manifest_files) == 0:
         logger.debug(f"No files paths read, check options -y or -l")
         sys.exit(1)
 
-    # get the real paths of the files
-    files = realpaths(files)
+    startup = time.perf_counter() - START_TIME
+    logger.debug(f"Startup took {1000 * startup:.1f} ms (target: {1000 * STARTUP_TARGET:.0f} ms)")
 
-    # Check duplicates
-    files = remove_duplicates(files)
+    if metrics is not None:
+        metrics['startup_seconds'] = startup
 
-    files = skip_dirs_and_absent(files)
+    with metrics_stage(metrics, 'check_files'):
+        # get the real paths of the files
+        files = realpaths(files)
 
-    # Generate unique ids
-    files = generate_ids(files)
+        files = skip_dirs_and_absent(files, metrics)
 
-    # parse the files
-    files = new_parser(files, args.functions, config)
+        # files from a fresh manifest only need a stat
+        files += manifest_check(manifest_files, metrics)
 
-    if args.format == 'template' or args.format == 'yaml':
-        if args.format == 'template':
-            if not os.path.exists(args.template):
-                logger.debug(f"Template file {args.template} not found")
-                sys.exit(1)
+        # Check duplicates
+        files = remove_duplicates(files, metrics)
 
-            # process the template
-            template = read_template(args.template)
-            cont = moustache_replace(config, template, files, args.functions)
+        # Generate unique ids
+        files = generate_ids(files)
 
-        else:
-            cont = yaml.dump(files, default_flow_style=False, sort_keys=False)
+    digests = None
 
-        # write to README.md or stdout
-        if not args.output:
-            print(cont)
-        else:
-            with open(args.output, 'w') as stream:
-                stream.write(cont)
+    if args.dedup_content or args.content_hash:
+        with metrics_stage(metrics, 'hash'):
+            digests = content_hashes(files)
+
+        if args.content_hash:
+            for f, digest in zip(files, digests):
+                f['content_hash'] = digest
 
-    elif args.format == 'csv':
-        save_csv(files, args.output, config)
+        if not args.dedup_content:
+            digests = None
 
+    # the manifest metadata is not part of the records
+    for f in files:
+        f.pop('_manifest', None)
+
+    # parse the files; jobs with the same parser config share the results
+    programs, index = job_programs(jobs)
+
+    if len(programs) == 1:
+        config, functions_file = programs[0]
+        results = [ new_parser(files, functions_file, config, metrics, digests) ]
     else:
-        raise ValueError(f"Unsupported format: {args.format}")
+        results = batch_parser(files, programs, metrics, digests)
+
+    for job, i in zip(jobs, index):
+        write_output(results[i], job, metrics)
+
+    if metrics is not None:
+        save_metrics(metrics, args.metrics, args.metrics_format)
@@ -1,45 +1,137 @@
 #!/usr/bin/env python3
-""" Convert a list of README paths into a YAML file. """
-""" Reads from STDIN and writes to STDOUT. """
+""" Convert a list of file paths into a YAML manifest for briv.
+
+Reads paths from STDIN and writes the manifest to STDOUT. For each file,
+the real path is recorded, and size, modification time and inode (and
+optionally a digest of the contents) are stored under the _manifest key. If an existing manifest is given
+with -u, it is updated: unchanged files are taken over as they are,
+changed files are updated and files which no longer exist are dropped.
+"""
 
 import os
-import yaml
 import sys
+import time
+import argparse
+
+MANIFEST_VERSION = 2
+
+def stat_entry(path, st, category = None, digest = False):
+    """ Create the manifest entry for a file """
+
+    entry = { 'name': os.path.basename(path), 'path': path }
+
+    if category:
+        entry['category'] = category
+
+    # bookkeeping, kept apart from the fields of the record
+    meta = { 'size': st.st_size, 'mtime': st.st_mtime, 'inode': st.st_ino }
+
+    if digest:
+        from briv import hash_file
+        meta['digest'] = hash_file(path)
+
+    entry['_manifest'] = meta
+
+    return entry
+
+def unchanged(entry, st):
+    """ Check whether the file changed since the entry was recorded """
+
+    meta = entry.get('_manifest') or { }
+
+    return meta.get('size') == st.st_size and meta.get('mtime') == st.st_mtime and meta.get('inode') == st.st_ino
+
+def update_entry(entry, digest = False):
+    """ Update an existing manifest entry; return None if file is gone """
+
+    try:
+        st = os.stat(entry['path'])
+    except OSError:
+        print("Warning: file does not exist: " + entry['path'], file=sys.stderr)
+        return None
+
+    if unchanged(entry, st) and (not digest or 'digest' in entry['_manifest']):
+        return entry
+
+    new = stat_entry(entry['path'], st, digest = digest)
+
+    # keep any additional fields (e.g. category)
+    return { **entry, **new }
+
+def new_entry(path, category = None, digest = False):
+    """ Create a manifest entry for a new path; return None if absent """
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        print("Warning: file does not exist: " + path, file=sys.stderr)
+        return None
+
+    if not os.path.isfile(path):
+        print("Warning: not a file: " + path, file=sys.stderr)
+        return None
+
+    return stat_entry(path, st, category, digest)
+
+def build_manifest(paths, old = None, category = None, digest = False):
+    """ Build the manifest from the list of paths, updating the old one """
+
+    files = { }
+
+    if old:
+        for entry in old.get('files') or [ ]:
+            entry = update_entry(entry, digest)
+            if entry:
+                files[entry['path']] = entry
+
+    for path in paths:
+        path = os.path.realpath(os.path.expanduser(path))
+
+        # already up to date
+        if path in files:
+            if category:
+                files[path]['category'] = category
+            continue
+
+        entry = new_entry(path, category, digest)
+        if entry:
+            files[path] = entry
+
+    manifest = { 'version': MANIFEST_VERSION, 'created': time.time() }
+
+    return { 'manifest': manifest, 'files': list(files.values()) }
 
 if __name__ == '__main__':
-    if len(sys.argv) > 2:
-        print("Usage: cat file.txt | python3 list2yaml.py [category] > file.yaml")
-        sys.exit(1)
 
-    if len(sys.argv) == 2:
-        category = sys.argv[1]
-    else:
-        category = None
+    parser = argparse.ArgumentParser(description="Convert a list of file paths (STDIN) into a YAML manifest (STDOUT)")
+    parser.add_argument('category', nargs = '?', help='Category to add to the new files', default = None)
+    parser.add_argument('--update', '-u', help='Existing manifest to update (new paths are read from STDIN unless it is a terminal)', default = None)
+    parser.add_argument('--digest', '-d', help='Record a digest of the file contents', action = 'store_true', default = False)
+    parser.add_argument('--output', '-o', help='File to write (default: stdout)', default = None)
 
-    # read filenames from STDIN
-    lines = sys.stdin.readlines()
-    lines = [ line.strip() for line in lines ]
+    args = parser.parse_args()
 
-    # tilde expansion
-    lines = [ os.path.expanduser(line) for line in lines ]
+    import yaml
 
-    # warning to stderr for every non-existent file
-    for line in lines:
-        if not os.path.exists(line):
-            print("Warning: file does not exist: " + line, file=sys.stderr)
+    old = None
 
-    # remove dirs which do not exist
-    lines = [ line for line in lines if os.path.exists(line) ]
+    if args.update and os.path.exists(args.update):
+        with open(args.update, 'r') as stream:
+            old = yaml.load(stream, Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
-    projects = [ { 'name': os.path.basename(os.path.dirname(line)), 'readme': os.path.realpath(line) } for line in lines ]
+    # read filenames from STDIN
+    if args.update and sys.stdin.isatty():
+        lines = [ ]
+    else:
+        lines = [ line.strip() for line in sys.stdin.readlines() ]
+        lines = [ line for line in lines if line ]
 
-    if category:
-        projects = [ { 'name': project['name'], 'readme': project['readme'], 'category': category } for project in projects ]
+    manifest = build_manifest(lines, old, args.category, args.digest)
 
-    print("projects:")
+    cont = yaml.dump(manifest, default_flow_style=False, sort_keys=False)
 
-    for p in projects:
-        print("  - name: " + p['name'])
-        print("    readme: " + p['readme'])
-        if category:
-            print("    category: " + category)
+    if not args.output:
+        print(cont, end = '')
+    else:
+        with open(args.output, 'w') as stream:
+            stream.write(cont)